@@ -1,14 +1,51 @@
 import sys
 import argparse
+import csv
 import os
 import subprocess
 import re
+import shutil
+import tempfile
+from bisect import bisect_left
 from collections import defaultdict
-from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+try:
+    import pysam
+except ImportError:
+    # Without pysam we fall back to shelling out to samtools view for every region
+    pysam = None
+
+SAM_RNAME_COL_INDEX = 2
 SAM_POS_COL_INDEX = 3
 SAM_CIGAR_COL_INDEX = 5
 
+# Skip secondary (256), QC-failed (512), duplicate (1024) and supplementary (2048) alignments
+SAM_EXCLUDED_FLAGS = 256 | 512 | 1024 | 2048
+MIN_MAPPING_QUALITY = 60
+
+# The samtools view command applying the same filters, to which the regions BED file and BAM file are appended. -M uses
+# the multi-region iterator, so that alignments overlapping several regions are only output once.
+SAMTOOLS_VIEW_ARGV_PREFIX = ('samtools', 'view', '-F', str(SAM_EXCLUDED_FLAGS), '-q', str(MIN_MAPPING_QUALITY), '-M')
+
+# pysam CIGAR operation codes: N is the intronic (reference skip) operation, and M, D, N, = and X consume the reference
+BAM_CREF_SKIP = 3
+CIGAR_OPS_CONSUMING_REFERENCE = frozenset([0, 2, 3, 7, 8])
+
+# CIGAR string tokens, e.g. '3M1D40M20N' -> [('3', 'M'), ('1', 'D'), ('40', 'M'), ('20', 'N')]
+CIGAR_TOKEN_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+CIGAR_LETTERS_NOT_CONSUMING_REFERENCE = frozenset('ISPH')
+
+# The transcript file lists chromosomes without the 'chr' prefix, whereas BAM headers may or may not use it
+CONTIG_NAME_FORMATS = ('chr{}', '{}')
+
+# How often the reduce step reports which gene file it is adding, and the write buffer for the final file
+PROGRESS_REPORT_INTERVAL = 512
+FINAL_FILE_BUFFER_SIZE = 1 << 20
+
+# Each worker process keeps its own BAM handles open across all of the genes it is given, with their contig names
+_alignment_files = {}
+
 
 def get_bam_files_in_folder(bam_folder):
     """Get a list of all the bam file paths in a given folder"""
@@ -22,22 +59,16 @@ def get_bam_files_in_folder(bam_folder):
 
 def length_of_first_intronic_section(cigar_string):
     """Calculate the intron span's length.
-    Intron length will be  last regex integer matching string before 'N' character. Example CIGAR string: '3M1D40M20N'
+    Intron length will be the integer immediately before the first 'N' character. Example CIGAR string: '3M1D40M20N'
     """
-    return int(re.findall('\d+', cigar_string.split('N')[0])[-1])
+    intron_start, intron_end = get_introns_from_cigar_string(cigar_string, 0)[0]
+    return intron_end - intron_start
 
 
 def num_of_matches_before_first_intronic_section(cigar_string):
     """Calculate the number of matches before intronic section of the CIGAR string. Example CIGAR string: '3M1D40M20N'
     """
-    pre_N = cigar_string.split('N')[0]
-    numbers = [int(regex_num) for regex_num in re.findall('\d+', pre_N)][0:-1]
-    letters = [regex_letter for regex_letter in re.findall('[A-Z]', pre_N)]
-    sum = 0
-    for t in zip(numbers, letters):
-        if t[1] not in {'I', 'S', 'P', 'H'}:
-            sum += t[0]
-    return sum
+    return get_introns_from_cigar_string(cigar_string, 0)[0][0]
 
 
 def write_cigar_debugging_info(cigar_string, num_matches_before_start, intron_length, pos, intron_start, intron_end):
@@ -52,14 +83,12 @@ def write_cigar_debugging_info(cigar_string, num_matches_before_start, intron_le
 
 
 def get_first_splice_junction(cigar_string, t_chrom, pos, verbose=False):
-    intron_length = length_of_first_intronic_section(cigar_string)
-    num_matches_before_intron_start = num_of_matches_before_first_intronic_section(cigar_string)
-    intron_start_position = pos + num_matches_before_intron_start # inclusive
-    intron_end_position = pos + num_matches_before_intron_start + intron_length # not inclusive
+    intron_start_position, intron_end_position = get_introns_from_cigar_string(cigar_string, pos)[0]
 
     if verbose:
         # For debugging purposes, if verbose is true, output some intermediate information
-        write_cigar_debugging_info(cigar_string, num_matches_before_intron_start, intron_length,
+        write_cigar_debugging_info(cigar_string, intron_start_position - pos,
+                                   intron_end_position - intron_start_position,
                                    pos, intron_start_position, intron_end_position)
 
     unique_splice_junction = '{},{},{}'.format(t_chrom, intron_start_position, intron_end_position)
@@ -67,18 +96,13 @@ def get_first_splice_junction(cigar_string, t_chrom, pos, verbose=False):
 
 
 def get_second_splice_junction(cigar_string, t_chrom, pos, first_splice_junction_end, verbose=False):
-    section_after_first_intron = cigar_string.split('N')[1]
-    num_matches_before_second_intron = \
-        num_of_matches_before_first_intronic_section(section_after_first_intron)
-    second_intron_length = length_of_first_intronic_section(section_after_first_intron)
-    second_intron_start_position = first_splice_junction_end + num_matches_before_second_intron
-    second_intron_end_position = second_intron_start_position + second_intron_length
+    second_intron_start_position, second_intron_end_position = get_introns_from_cigar_string(cigar_string, pos)[1]
 
     # For debugging purposes, if verbose is true, output some intermediate information
     if verbose:
-        write_cigar_debugging_info(cigar_string, num_matches_before_second_intron,
-                                   second_intron_length, pos, second_intron_start_position,
-                                   second_intron_end_position)
+        write_cigar_debugging_info(cigar_string, second_intron_start_position - first_splice_junction_end,
+                                   second_intron_end_position - second_intron_start_position, pos,
+                                   second_intron_start_position, second_intron_end_position)
 
     unique_splice_junction = '{},{},{}'.format(t_chrom, second_intron_start_position,
                                                second_intron_end_position)
@@ -89,53 +113,229 @@ def get_end_position_from_junction(unique_splice_junction):
     return int(unique_splice_junction.split(',')[2])
 
 
-def find_splice_junctions(bam_file_path, t_chrom, t_start, t_stop, verbose=False):
-    """The meat of the script. Use samtools view along with some included filtering parameters described below to
-    view reads and alignments representing intronic regions, then parse the CIGAR strings to figure out the start and
-    end positions of these regions.
+def get_introns_from_cigartuples(cigartuples, pos):
+    """Walk the CIGAR operations of a read, as parsed by pysam, and return the (start, end) of every intronic section.
+    Start positions are inclusive and end positions are not inclusive, matching get_first_splice_junction."""
+    introns = []
+    ref_position = pos
+    for op, length in cigartuples:
+        if op == BAM_CREF_SKIP:
+            introns.append((ref_position, ref_position + length))
+        if op in CIGAR_OPS_CONSUMING_REFERENCE:
+            ref_position += length
+    return introns
+
+
+def get_introns_from_cigar_string(cigar_string, pos):
+    """Same as get_introns_from_cigartuples, but for a CIGAR string as output by samtools view. All of the intronic
+    sections are found in one pass over the string, instead of splitting it around each 'N' character."""
+    introns = []
+    ref_position = pos
+    for length, letter in CIGAR_TOKEN_PATTERN.findall(cigar_string):
+        length = int(length)
+        if letter == 'N':
+            introns.append((ref_position, ref_position + length))
+        if letter not in CIGAR_LETTERS_NOT_CONSUMING_REFERENCE:
+            ref_position += length
+    return introns
+
+
+def count_read_splice_junctions(intron_counts, introns, pos, cigar_string, verbose=False):
+    """Count the (start, end) introns spanned by one read. Account for only one intronic region, or two in the case of
+    very small retained introns (they must be small for the whole intron to have been captured within the length of one
+    read), e.g. 13M221400N34M2658N29M"""
+    if len(introns) > 2:
+        return
+
+    region_start = pos
+    for intron_start_position, intron_end_position in introns:
+        if verbose:
+            # For debugging purposes, if verbose is true, output some intermediate information
+            write_cigar_debugging_info(cigar_string, intron_start_position - region_start,
+                                       intron_end_position - intron_start_position, pos,
+                                       intron_start_position, intron_end_position)
+        region_start = intron_end_position
+        intron_counts[(intron_start_position, intron_end_position)] += 1
+
+
+def get_alignment_file(bam_file_path, htslib_threads=1):
+    """Return this worker process's open handle on a BAM file, opening it on first use, along with the set of contig
+    names in its header. Keeping the handle open means the BAM index is only loaded once per worker rather than once per
+    gene, and AlignmentFile.references rebuilds a tuple of every contig name each time it is accessed."""
+    alignment_file_and_contig_names = _alignment_files.get(bam_file_path)
+    if alignment_file_and_contig_names is None:
+        alignment_file = pysam.AlignmentFile(bam_file_path, 'rb', threads=htslib_threads)
+        alignment_file_and_contig_names = (alignment_file, frozenset(alignment_file.references))
+        _alignment_files[bam_file_path] = alignment_file_and_contig_names
+    return alignment_file_and_contig_names
+
+
+def get_contig_names_with_samtools(bam_file_path):
+    """Get the names of the reference sequences listed in the @SQ lines of the BAM header"""
+    contig_names = set()
+    for line in subprocess.check_output(['samtools', 'view', '-H', bam_file_path]).decode('ascii').splitlines():
+        if line.startswith('@SQ'):
+            for field in line.split('\t')[1:]:
+                if field.startswith('SN:'):
+                    contig_names.add(field[len('SN:'):])
+    return contig_names
+
+
+def index_regions_by_contig(regions, contig_names):
+    """Group (t_chrom, t_start, t_stop) regions by the name the BAM header uses for their contig, sorted by start
+    position so that the regions containing a read can be found by bisection. Regions on contigs missing from the
+    header are left out."""
+    chrom_to_contig = {}
+    for t_chrom, _, _ in regions:
+        if t_chrom not in chrom_to_contig:
+            chrom_to_contig[t_chrom] = next((contig_name_format.format(t_chrom)
+                                             for contig_name_format in CONTIG_NAME_FORMATS
+                                             if contig_name_format.format(t_chrom) in contig_names), None)
+
+    regions_by_contig = defaultdict(list)
+    for region_index, (t_chrom, t_start, t_stop) in enumerate(regions):
+        contig = chrom_to_contig[t_chrom]
+        if contig is not None:
+            regions_by_contig[contig].append((t_start, t_stop, region_index))
+
+    for contig, contig_regions in regions_by_contig.items():
+        contig_regions.sort()
+        starts = [t_start for t_start, _, _ in contig_regions]
+        max_region_length = max(t_stop - t_start for t_start, t_stop, _ in contig_regions)
+        regions_by_contig[contig] = (starts, contig_regions, max_region_length)
+    return dict(regions_by_contig)
+
+
+def find_regions_containing(contig_regions, pos):
+    """Return the indices of the regions for which t_start < pos < t_stop, the same window a single region query
+    applies to read start positions"""
+    starts, contig_regions, max_region_length = contig_regions
+    first = bisect_left(starts, pos - max_region_length)
+    last = bisect_left(starts, pos)
+    return [region_index for t_start, t_stop, region_index in contig_regions[first:last] if pos < t_stop]
+
+
+def find_splice_junctions(bam_file_path, regions, verbose=False, htslib_threads=1):
+    """The meat of the script. Fetch the reads overlapping the (t_chrom, t_start, t_stop) regions from the BAM file,
+    applying the same filters as the samtools view command in find_splice_junctions_with_samtools, and use the already
+    parsed CIGAR operations of each read to figure out the start and end positions of its intronic regions. Regions
+    that overlap are covered by one fetch, so reads they share are only decoded once. Returns one dictionary of
+    (start, end) intron counts per region."""
+    alignment_file, contig_names = get_alignment_file(bam_file_path, htslib_threads)
+    regions_by_contig = index_regions_by_contig(regions, contig_names)
+
+    # A dictionary per region that will keep track of how many times a particular (start, end) intron is found
+    intron_counts = [defaultdict(int) for _ in regions]
+
+    for contig, contig_regions in regions_by_contig.items():
+        starts, regions_on_contig, _ = contig_regions
+        fetch_stop = max(t_stop for _, t_stop, _ in regions_on_contig)
+
+        # pysam regions are 0-based and half-open, whereas samtools regions are 1-based and inclusive
+        for read in alignment_file.fetch(contig, starts[0] - 1, fetch_stop):
+            if read.flag & SAM_EXCLUDED_FLAGS or read.mapping_quality < MIN_MAPPING_QUALITY:
+                continue
+
+            # Most reads aren't spliced, and checking the CIGAR string for an 'N' is cheaper than building the
+            # CIGAR operation tuples. Unmapped reads have no CIGAR string at all.
+            cigar_string = read.cigarstring
+            if not cigar_string or 'N' not in cigar_string:
+                continue
+
+            pos = read.reference_start + 1  # 1-based, as reported in the POS column by samtools view
+            region_indices = find_regions_containing(contig_regions, pos)
+            if not region_indices:
+                continue
+
+            introns = get_introns_from_cigartuples(read.cigartuples, pos)
+            for region_index in region_indices:
+                count_read_splice_junctions(intron_counts[region_index], introns, pos, cigar_string, verbose=verbose)
+
+    return intron_counts
+
+
+def find_splice_junctions_with_samtools(bam_file_path, regions, verbose=False):
+    """Fallback for when pysam is not installed. Use a single samtools view across all of the (t_chrom, t_start,
+    t_stop) regions, along with some included filtering parameters described below, to view reads and alignments
+    representing intronic regions, then parse the CIGAR strings to figure out the start and end positions of these
+    regions. Running samtools once per sample, rather than once per gene and sample, means samtools is started and the
+    BAM index is loaded only once. Returns one dictionary of (start, end) intron counts per region.
 
     # Samtools view options used here:
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # -F INT: Do not output alignments with any bits set in INT present in the FLAG field
     # -q INT: Skip alignments with MAPQ smaller than INT
+    # -M: Use the multi-region iterator, which outputs alignments overlapping several regions only once
+    # -L FILE: Only output alignments overlapping the regions in this BED file
     """
-    t_location = '{}:{}-{}'.format(t_chrom, t_start, t_stop)
-    pos = 'chr{}:{}-{}'.format(t_chrom, t_start, t_stop)
-    samtools_view = 'samtools view -F 256 -F 512 -F 1024 -F 2048 -q 60 {} {} {}'.format(bam_file_path, pos,  t_location)
-    # Run the samtools view command using subprocess, and place the stdout output into the sam_view variable as a string
-    sam_view = subprocess.check_output(samtools_view.split())
-
-    # Split the sam_view output string into each line comprising it
-    sam_lines = str(sam_view).split('\n')
+    # Check the contig naming of the BAM header once, so that each region is only listed under the one name that exists
+    regions_by_contig = index_regions_by_contig(regions, get_contig_names_with_samtools(bam_file_path))
 
-    # A dictionary that will keep track of how many times a particular junction is found
-    splice_junctions = defaultdict(int)
+    # BED intervals are 0-based and half-open, whereas samtools regions are 1-based and inclusive
+    with tempfile.NamedTemporaryFile('w', suffix='.bed', delete=False) as regions_bed:
+        for contig, (_, contig_regions, _) in regions_by_contig.items():
+            for t_start, t_stop, _ in contig_regions:
+                regions_bed.write('{}\t{}\t{}\n'.format(contig, t_start - 1, t_stop))
 
-    # Only look at the exon junction spanning lines, for which the CIGAR string will contain an 'N' character
-    for line in sam_lines:
-        try:
-            split_line = line.split('\t')
-            cigar_string = split_line[SAM_CIGAR_COL_INDEX]
-            pos = int(split_line[SAM_POS_COL_INDEX])
-            if 'N' in cigar_string and t_start < pos < t_stop:
-                    # Account for only one intronic region, or only the first of two in the case there are two
-                    if cigar_string.count('N') <= 2:
-                        unique_splice_junction = get_first_splice_junction(cigar_string, t_chrom, pos, verbose=verbose)
-                        splice_junctions[unique_splice_junction] += 1
+    # The samtools output is parsed as bytes, so look contigs up by their encoded name
+    regions_by_contig_bytes = {contig.encode('ascii'): contig_regions
+                               for contig, contig_regions in regions_by_contig.items()}
 
-                    # Account for very small retained introns (they must be small for the whole intron to have been
-                    # captured within the length of one read), e.g. 13M221400N34M2658N29M
-                    if cigar_string.count('N') == 2 and unique_splice_junction:
-                        intron_end_position = get_end_position_from_junction(unique_splice_junction)  # not inclusive
-                        unique_splice_junction = get_second_splice_junction(cigar_string, t_chrom, pos,
-                                                                            intron_end_position, verbose=verbose)
+    samtools_argv = list(SAMTOOLS_VIEW_ARGV_PREFIX) + ['-L', regions_bed.name, bam_file_path]
 
-                        splice_junctions[unique_splice_junction] += 1
+    # A dictionary per region that will keep track of how many times a particular (start, end) intron is found
+    intron_counts = [defaultdict(int) for _ in regions]
 
-        except IndexError:
-            pass
+    try:
+        # Run the samtools view command using subprocess, and stream its stdout line by line rather than holding all
+        # of the sample's reads in memory at once
+        samtools_process = subprocess.Popen(samtools_argv, stdout=subprocess.PIPE, bufsize=1 << 20)
 
-    return splice_junctions
+        completed = False
+        try:
+            # Only look at the exon junction spanning lines, for which the CIGAR string will contain an 'N' character
+            for line in samtools_process.stdout:
+                # Most reads aren't spliced, so skip lines without any 'N' before paying to split them
+                if b'N' not in line:
+                    continue
+                try:
+                    # Only the columns up to and including the CIGAR string are needed
+                    split_line = line.split(b'\t', SAM_CIGAR_COL_INDEX + 1)
+                    # The 'N' may have been in another column, such as the read name. The CIGAR string is checked,
+                    # and the read placed in its regions, as bytes, so that only reads which are counted are
+                    # decoded.
+                    if b'N' not in split_line[SAM_CIGAR_COL_INDEX]:
+                        continue
+
+                    contig_regions = regions_by_contig_bytes.get(split_line[SAM_RNAME_COL_INDEX])
+                    if contig_regions is None:
+                        continue
+
+                    pos = int(split_line[SAM_POS_COL_INDEX])
+                    region_indices = find_regions_containing(contig_regions, pos)
+                    if region_indices:
+                        cigar_string = split_line[SAM_CIGAR_COL_INDEX].decode('ascii')
+                        introns = get_introns_from_cigar_string(cigar_string, pos)
+                        for region_index in region_indices:
+                            count_read_splice_junctions(intron_counts[region_index], introns, pos, cigar_string,
+                                                        verbose=verbose)
+
+                except IndexError:
+                    pass
+
+            completed = True
+        finally:
+            samtools_process.stdout.close()
+            if not completed:
+                # Parsing stopped early, so samtools may be left blocked writing to the closed pipe
+                samtools_process.kill()
+            return_code = samtools_process.wait()
+        if return_code:
+            raise subprocess.CalledProcessError(return_code, samtools_argv)
+    finally:
+        os.remove(regions_bed.name)
+
+    return intron_counts
 
 
 def get_id_from_bam_name(bam_file_path):
@@ -145,79 +345,169 @@ def get_id_from_bam_name(bam_file_path):
 
 
 def summarize_splice_junctions(gene, global_event_counts, sample_ids, output_dir='.'):
-    """Given a dictionary summarizing the global and per sample occurrence counts of unique splice junctions,
-    output a file summarizing the results"""
+    """Given a dictionary summarizing the global and per sample occurrence counts of unique splice junctions, keyed by
+    (gene, gene_type, chrom, start, end) tuples, output a file summarizing the results"""
     output_file_name = '{}/{}_{}_junctions.txt'.format(output_dir, gene, len(global_event_counts))
     with open(output_file_name, 'w') as f:
-        ordered_events = sorted(global_event_counts.keys())
-        for event in ordered_events:
-            per_sample_counts = global_event_counts[event]
-            gene, gene_type, chrom, start, end = event.split(',')
-
-            total_count = 0
+        f.writelines(format_splice_junction_entry(event, global_event_counts[event], sample_ids)
+                     for event in sorted(global_event_counts.keys()))
 
-            sample_counts = [str(per_sample_counts.get(s, 0)) for s in sample_ids]
 
-            for count in sample_counts:
-                total_count += int(count)
+def format_splice_junction_entry(event, per_sample_counts, sample_ids):
+    """Format one line of a gene's splice junction file. Counts stay ints until the line is joined, rather than being
+    converted to strings and parsed back to sum them."""
+    gene, gene_type, chrom, start, end = event
+    sample_counts = [per_sample_counts.get(s, 0) for s in sample_ids]
+    num_samples_with_this_event = len(per_sample_counts)
+    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(gene, gene_type, chrom, start, end, sum(sample_counts),
+                                                   num_samples_with_this_event, '\t'.join(map(str, sample_counts)))
 
-            num_samples_with_this_event = len(per_sample_counts)
 
-            entry = '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(gene, gene_type, chrom, start, end, total_count,
-                                                               num_samples_with_this_event, '\t'.join(sample_counts))
-            f.write(entry)
-
-
-def find_splice_junctions_for_gene(pool_arguments):
-    """Find the splice junctions across all samples for one gene, writing the results to a file
-    specific to this gene"""
+def summarize_gene_splice_junctions(pool_arguments, sample_id_to_splice_junctions):
+    """Combine the splice junctions found in each sample for one gene, writing the results to a file specific to this
+    gene"""
     pa = pool_arguments
     # A dictionary to keep track of, for each unique splice junction event, how many times it appears in each of the
     # samples being considered as part of this analysis for this gene.
-    global_event_counts = defaultdict(lambda: defaultdict())
-    sample_id_to_bam_file_path = pa.get('sample_id_to_bam_file_path')
-    sorted_sample_ids = sorted(sample_id_to_bam_file_path.keys())
+    global_event_counts = defaultdict(dict)
+    sorted_sample_ids = sorted(sample_id_to_splice_junctions.keys())
+
+    t_gene = pa['t_gene']
+    gene_info = (t_gene, pa['t_gene_type'], pa['t_chrom'])
 
     for sample_id in sorted_sample_ids:
-        bam_file_path = sample_id_to_bam_file_path.get(sample_id)
-        if pa.get('verbose'):
-            sys.stdout.write("Sample: {}\tGene: {}\n".format(sample_id, pa.get('t_gene')))
-        splice_junctions = find_splice_junctions(bam_file_path,
-                                                 pa.get('t_chrom'),
-                                                 int(pa.get('t_start')),
-                                                 int(pa.get('t_stop')),
-                                                 verbose=pa.get('verbose'))
-        for splice_junction, count in splice_junctions.items():
-            splice_junction_with_gene_info = '{},{},{}'.format(pa.get('t_gene'), pa.get('t_gene_type'), splice_junction)
-            global_event_counts[splice_junction_with_gene_info][sample_id] = count
-    summarize_splice_junctions(pa.get('t_gene'), global_event_counts, sorted_sample_ids, pa.get('output_dir'))
-
-
-def map_splice_junction_discovery_across_genes(threads, transcript_file, sample_id_to_bam_file_path, verbose=False, output_dir=None):
-    """Set up the parameters to map the splice junction discovery functions across all genes in a threaded manner"""
-    pool_args = []
-    pool = ThreadPool(threads)
-    transcript_lines = open(transcript_file).readlines()
-    for t in transcript_lines:
+        for intron, count in sample_id_to_splice_junctions[sample_id].items():
+            global_event_counts[gene_info + intron][sample_id] = count
+    summarize_splice_junctions(t_gene, global_event_counts, sorted_sample_ids, pa['output_dir'])
+
+
+def group_overlapping_genes(pool_args):
+    """Group the genes whose regions overlap on the same chromosome, e.g. isoforms or nested genes, so that the reads
+    they share can be fetched once for all of them"""
+    gene_groups = []
+    group_stop = None
+    for pa in sorted(pool_args, key=lambda pa: (pa['t_chrom'], pa['t_start'])):
+        if gene_groups and pa['t_chrom'] == gene_groups[-1][0]['t_chrom'] and pa['t_start'] < group_stop:
+            gene_groups[-1].append(pa)
+            group_stop = max(group_stop, pa['t_stop'])
+        else:
+            gene_groups.append([pa])
+            group_stop = pa['t_stop']
+    return gene_groups
+
+
+def find_splice_junctions_for_genes(gene_pool_arguments):
+    """Find the splice junctions across all samples for a group of overlapping genes, writing the results to a file
+    specific to each gene"""
+    pa = gene_pool_arguments[0]
+    sample_id_to_bam_file_path = pa['sample_id_to_bam_file_path']
+    verbose = pa['verbose']
+    htslib_threads = pa['htslib_threads']
+    regions = [(gene_pa['t_chrom'], gene_pa['t_start'], gene_pa['t_stop']) for gene_pa in gene_pool_arguments]
+    t_genes = ','.join(gene_pa['t_gene'] for gene_pa in gene_pool_arguments)
+    sample_id_to_splice_junctions = {}
+
+    for sample_id in sorted(sample_id_to_bam_file_path.keys()):
         if verbose:
-            sys.stdout.write('>> {}\n'.format(t))
-        if 'CHROM' in t:
-            continue
-        t_gene, t_enst, _, t_chrom, t_start, t_stop, t_gene_type = t.split('\t')
-        t_gene = t_gene.split('\n')[0]
-        t_gene_type = t_gene_type.split('\n')[0]
-        pool_args.append({'sample_id_to_bam_file_path': sample_id_to_bam_file_path,
-                          't_gene': t_gene,
-                          't_gene_type': t_gene_type,
-                          't_chrom': t_chrom,
-                          't_start': int(t_start),
-                          't_stop': int(t_stop),
-                          'verbose': verbose,
-                          'output_dir': output_dir})
-
-    pool.map(find_splice_junctions_for_gene, pool_args)
-    pool.close()
-    pool.join()
+            sys.stdout.write("Sample: {}\tGene: {}\n".format(sample_id, t_genes))
+        sample_id_to_splice_junctions[sample_id] = find_splice_junctions(sample_id_to_bam_file_path[sample_id],
+                                                                         regions,
+                                                                         verbose=verbose,
+                                                                         htslib_threads=htslib_threads)
+
+    for gene_index, gene_pa in enumerate(gene_pool_arguments):
+        summarize_gene_splice_junctions(gene_pa, {sample_id: splice_junctions[gene_index] for sample_id, splice_junctions
+                                                  in sample_id_to_splice_junctions.items()})
+
+
+def find_splice_junctions_for_sample(pool_arguments):
+    """Find the splice junctions across all genes for one sample with samtools, for when pysam is not installed"""
+    pa = pool_arguments
+    if pa.get('verbose'):
+        sys.stdout.write("Sample: {}\n".format(pa.get('sample_id')))
+    return find_splice_junctions_with_samtools(pa.get('bam_file_path'), pa.get('regions'), verbose=pa.get('verbose'))
+
+
+def map_splice_junction_discovery_across_genes(threads, transcript_file, sample_id_to_bam_file_path, verbose=False, output_dir=None,
+                                               htslib_threads=1):
+    """Set up the parameters to map the splice junction discovery functions across all genes, spreading the genes over
+    a pool of worker processes so that read parsing runs in parallel rather than contending for the GIL"""
+    pool_args = []
+    with open(transcript_file, newline='') as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if verbose:
+                sys.stdout.write('>> {}\n'.format('\t'.join(row)))
+            # Skip blank lines and the header line, which has a CHROM column
+            if not row or 'CHROM' in row:
+                continue
+            t_gene, t_enst, _, t_chrom, t_start, t_stop, t_gene_type = (field.strip() for field in row)
+            pool_args.append({'sample_id_to_bam_file_path': sample_id_to_bam_file_path,
+                              't_gene': t_gene,
+                              't_gene_type': t_gene_type,
+                              't_chrom': t_chrom,
+                              't_start': int(t_start),
+                              't_stop': int(t_stop),
+                              'verbose': verbose,
+                              'output_dir': output_dir,
+                              'htslib_threads': htslib_threads})
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        if pysam is not None:
+            # Start the largest groups of genes first so that a long one picked up late doesn't leave the other workers
+            # idle
+            gene_groups = group_overlapping_genes(pool_args)
+            gene_groups.sort(key=lambda genes: max(pa['t_stop'] for pa in genes) - genes[0]['t_start'], reverse=True)
+            # Hand out one group at a time, so that whichever worker frees up first takes the next largest group
+            # rather than the workers being given fixed batches up front
+            futures = [executor.submit(find_splice_junctions_for_genes, genes) for genes in gene_groups]
+            for future in as_completed(futures):
+                # Re-raise any exception raised in a worker here
+                future.result()
+            return
+
+        # Without pysam, invert the loop: a few samtools views per sample cover every gene, and the per gene results
+        # of all samples are combined afterwards. With fewer samples than threads (e.g. a single --bam_file), one
+        # samtools view per sample would leave the other workers idle, so each sample's genes are split into enough
+        # chunks of consecutive regions to give every worker a samtools view to run.
+        regions = [(pa['t_chrom'], pa['t_start'], pa['t_stop']) for pa in pool_args]
+        sample_ids = sorted(sample_id_to_bam_file_path.keys())
+        chunks_per_sample = max(1, -(-threads // max(1, len(sample_ids))))
+        chunk_size = max(1, -(-len(regions) // chunks_per_sample))
+        region_chunks = [regions[chunk_start:chunk_start + chunk_size]
+                         for chunk_start in range(0, len(regions), chunk_size)]
+        sample_args = [{'sample_id': sample_id,
+                        'bam_file_path': sample_id_to_bam_file_path[sample_id],
+                        'regions': region_chunk,
+                        'verbose': verbose} for sample_id in sample_ids for region_chunk in region_chunks]
+
+        # Each chunk returns the intron counts of its own regions, in order, so a sample's chunks are concatenated
+        sample_id_to_splice_junctions = defaultdict(list)
+        for chunk_args, splice_junctions in zip(sample_args,
+                                                executor.map(find_splice_junctions_for_sample, sample_args)):
+            sample_id_to_splice_junctions[chunk_args['sample_id']].extend(splice_junctions)
+
+    for gene_index, pa in enumerate(pool_args):
+        summarize_gene_splice_junctions(pa, {sample_id: splice_junctions[gene_index] for sample_id, splice_junctions
+                                             in sample_id_to_splice_junctions.items()})
+
+
+def append_file(source_file_path, destination_file):
+    """Append the contents of a file to an open binary file. Where os.sendfile supports copying between regular files
+    (Linux), the data is copied within the kernel rather than through a user space buffer."""
+    destination_file.flush()
+    with open(source_file_path, 'rb') as source_file:
+        size = os.fstat(source_file.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(destination_file.fileno(), source_file.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            # No os.sendfile, or one that only sends to sockets (e.g. macOS), so copy the rest in user space
+            source_file.seek(offset)
+            shutil.copyfileobj(source_file, destination_file, 1 << 20)
 
 
 def main():
@@ -230,6 +520,8 @@ def main():
     parser.add_argument('--bam_file', metavar='bam_file', type=str)
     parser.add_argument('--sample_id', metavar='sample_id', type=str, default='#')
     parser.add_argument('--threads', metavar='threads', type=int, default=10)
+    parser.add_argument('--htslib_threads', metavar='htslib_threads', type=int, default=1,
+                        help='Number of htslib threads used to decompress each BAM (1 = none extra)')
     parser.add_argument('--output_dir', metavar='output_dir', type=str)
     parser.add_argument('-v', action='store_true')
     parser.add_argument('-keep_gene_files', action='store_true')
@@ -241,6 +533,7 @@ def main():
     output_dir = args.output_dir
     threads = args.threads
     verbose = args.v
+    htslib_threads = args.htslib_threads
 
     # This is for the case where we want to process splice junctions one file at a time
     bam_file = args.bam_file
@@ -248,7 +541,7 @@ def main():
 
     if not output_dir:
         output_dir = 'sjd_output'
-        subprocess.call(['mkdir', output_dir])
+        os.makedirs(output_dir, exist_ok=True)
 
     final_filename = '{}/final.txt'.format(output_dir)
     if os.path.isfile(final_filename):
@@ -270,23 +563,29 @@ def main():
 
     # Mapping -- find the splice junctions across all samples, one gene per thread. Each thread generates a file.
     sys.stdout.write('>> Discovering splice junctions across all genes\n')
-    map_splice_junction_discovery_across_genes(threads, transcript_file, sample_id_to_bam_file_path, verbose, output_dir)
+    if pysam is None:
+        sys.stdout.write('>> pysam is not installed, so reads will be parsed from samtools view output instead\n')
+    map_splice_junction_discovery_across_genes(threads, transcript_file, sample_id_to_bam_file_path, verbose, output_dir,
+                                               htslib_threads)
 
     # Reducing -- combine all of the files generated into one megafile which includes all lines.
     sys.stdout.write('>> Combining all data into final file: {}\n'.format(final_filename))
-    for root, dirs, files in os.walk(output_dir):
-        open(final_filename, "w")
-        subprocess.call("echo 'Gene\tType\tChrom\tStart\tEnd\tNTimesSeen\tNSamplesSeen\t{}' >> {}".format(
-            '\t'.join(sample_ids),
-            final_filename), shell=True)
-        for file_counter, file in enumerate(sorted([f for f in files if f != final_filename])):
-            gene_output_file = '{}/{}'.format(root, file)
-            sys.stdout.write('\t* ({}/{}) adding data from {}\n'.format(file_counter+1, len(files), gene_output_file))
-            subprocess.call('cat {} >> {}'.format(gene_output_file, final_filename), shell=True)
+    gene_output_files = sorted(f for f in os.listdir(output_dir) if f.endswith('_junctions.txt'))
+    with open(final_filename, 'wb', buffering=FINAL_FILE_BUFFER_SIZE) as final_file:
+        # The per sample columns of each gene file are in sorted sample ID order
+        final_file.write('Gene\tType\tChrom\tStart\tEnd\tNTimesSeen\tNSamplesSeen\t{}\n'.format(
+            '\t'.join(sorted(sample_ids))).encode())
+        for file_counter, file in enumerate(gene_output_files):
+            gene_output_file = os.path.join(output_dir, file)
+            # Only report every so often, since a line per gene file adds up to one write per gene
+            if (file_counter + 1) % PROGRESS_REPORT_INTERVAL == 0 or file_counter + 1 == len(gene_output_files):
+                sys.stdout.write('\t* ({}/{}) adding data from {}\n'.format(file_counter+1, len(gene_output_files),
+                                                                             gene_output_file))
+            append_file(gene_output_file, final_file)
             # After feeding the contents into the aggregate file, delete the gene-level file
             if not args.keep_gene_files:
-                subprocess.call('rm {}'.format(gene_output_file), shell=True)
-        sys.stdout.write(">> Done! Output is in final file: {}\n".format(final_filename))
+                os.remove(gene_output_file)
+    sys.stdout.write(">> Done! Output is in final file: {}\n".format(final_filename))
 
 
 if __name__ == '__main__':
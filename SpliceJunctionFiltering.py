@@ -8,7 +8,17 @@ def main(args):
     normalized_file = args.normalized
     min_supporting_reads = args.min_supporting_reads
     output_dir = args.output_dir
-    df = pd.read_csv(normalized_file, sep='\t', header=0)
+    columns = list(pd.read_csv(normalized_file, sep='\t', header=0, nrows=0).columns)
+    start_position_of_sample_count_columsn = 7
+    end_position_of_sample_count_columns = columns.index('Annotations')
+    sample_names = columns[start_position_of_sample_count_columsn: end_position_of_sample_count_columns]
+
+    # Sample counts fit in 32 bits and the descriptive columns repeat the same few values on every row, so read them
+    # as narrower types than pandas would infer
+    column_types = {sample_name: 'int32' for sample_name in sample_names}
+    column_types.update({'Gene': 'category', 'Type': 'category', 'Chrom': 'category', 'Annotations': 'category',
+                         'SeenInTranscriptsList': 'int8'})
+    df = pd.read_csv(normalized_file, sep='\t', header=0, dtype=column_types, engine='c')
 
     sys.stdout.write("{} total splice junctions\n".format(len(df)))
     sys.stdout.write("Filtering out {} annotated splice junctions...\n".format(len(df[df['SeenInTranscriptsList'] == 1])))
@@ -17,18 +27,12 @@ def main(args):
 
     sys.stdout.write("Filtering out sites where all samples had below {} reads...\n".format(min_supporting_reads))
 
-    start_position_of_sample_count_columsn = 7
-    end_position_of_sample_count_columns = list(df.columns).index('Annotations')
-    sample_names = df.columns[start_position_of_sample_count_columsn: end_position_of_sample_count_columns]
-
-    eval_command = '&'.join(
-        ["((df[\'{}\'] >= {}) | (df[\'{}\'] == 0))".format(sample_name, min_supporting_reads, sample_name)
-         for sample_name in sample_names])
-    print('Command: {}\n'.format(eval_command))
-
-    and_sub_clauses_for_df = eval(eval_command)
+    # A site is kept only if every sample either has no reads for it or has at least min_supporting_reads, checked
+    # over the whole block of sample count columns at once
+    sample_counts = df[sample_names].to_numpy()
+    sites_supported_in_all_samples = ((sample_counts >= min_supporting_reads) | (sample_counts == 0)).all(axis=1)
 
-    candidate_sites = df[and_sub_clauses_for_df]
+    candidate_sites = df[sites_supported_in_all_samples]
     sys.stdout.write('{} candidate sites\n'.format(len(candidate_sites)))
 
     candidate_sites.to_csv('{}/candidates.{}'.format(output_dir, path.basename(normalized_file)), sep='\t')
@@ -1,6 +1,11 @@
 import argparse
 import gzip
-from collections import defaultdict
+import sys
+from collections import namedtuple
+
+
+# One line of the SpliceJunctionDiscovery.py output, with samptimes listing the count of each sample in header order
+Junction = namedtuple('Junction', ['gene', 'gene_type', 'chrom', 'start', 'stop', 'ntimes', 'nsamp', 'samptimes'])
 
 
 def get_annotated_counts(splice_junctions, annotated_junctions):
@@ -8,24 +13,21 @@ def get_annotated_counts(splice_junctions, annotated_junctions):
     carry it. E.g. if both of the following junctions were annotated:
         2:100-250 Beryl:20, Besse:10
         2:100-360 Beryl:30, Besse 4
-    then the dictionary created should look like this:
-        {'2:100' :{'Beryl':30,'Besse':10},  2:250: {'Beryl':20,'Besse':10}, 2:360: {'Beryl':30, 'Besse': 4}"""
-    # {"chromosome:position": sample : times_seen_in_sample}
-    annotated_counts = defaultdict(lambda: defaultdict(lambda: int))
+    then the dictionary created should look like this, with counts listed in the same sample order as samptimes:
+        {('2', '100'): [30, 10], ('2', '250'): [20, 10], ('2', '360'): [30, 4]}"""
+    # {(chromosome, position): [times_seen_in_sample, ...]}
+    annotated_counts = {}
     for junction in splice_junctions:
-        chrom, start, stop, samptimes = junction.get('chrom'), junction.get('start'), junction.get('stop'),\
-                                        junction.get('samptimes')
-        junction_string = '{}:{}-{}'.format(chrom, start, stop)
-        if junction_string in annotated_junctions:  # only consider both annotated
-
-            for pos in [start, stop]:
-                pos = "{}:{}".format(chrom, pos)
-                for sample, count in samptimes.items():
-                    existing_count_for_sample_at_pos = annotated_counts[pos].get(sample)
-                    if not existing_count_for_sample_at_pos:
-                        annotated_counts[pos][sample] = count
-                    elif existing_count_for_sample_at_pos and count > existing_count_for_sample_at_pos:
-                        annotated_counts[pos][sample] = count
+        chrom, start, stop, samptimes = junction.chrom, junction.start, junction.stop, junction.samptimes
+        if (chrom, start, stop) in annotated_junctions:  # only consider both annotated
+
+            for pos in [(chrom, start), (chrom, stop)]:
+                existing_counts_at_pos = annotated_counts.get(pos)
+                if existing_counts_at_pos is None:
+                    annotated_counts[pos] = list(samptimes)
+                else:
+                    annotated_counts[pos] = [max(existing_count, count)
+                                             for existing_count, count in zip(existing_counts_at_pos, samptimes)]
     return annotated_counts
 
 
@@ -35,99 +37,70 @@ def normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_j
         '\t'.join(['{}_normed'.format(s.strip()) for s in sample_ids])
     ))
     for junction in splice_junctions:
-        normalized_dict = {}
-
-        gene, gene_type, chrom, start, stop, ntimes, nsamp, samptimes = junction.get('gene'), \
-                                                                        junction.get('gene_type'), \
-                                                                        junction.get('chrom'), junction.get('start'), \
-                                                                        junction.get('stop'), junction.get('ntimes'),\
-                                                                        junction.get('nsamp'), junction.get('samptimes')
-
-        sample_counts_sorted = [samptimes.get(s) for s in sample_ids]
-        annotated_start = annotated_counts.get('{}:{}'.format(chrom, start))
-        annotated_stop = annotated_counts.get('{}:{}'.format(chrom, stop))
-        junction_string = '{}:{}-{}'.format(chrom, start, stop)
+        gene, gene_type, chrom, start, stop, ntimes, nsamp, samptimes = junction
+
+        annotated_start = annotated_counts.get((chrom, start))
+        annotated_stop = annotated_counts.get((chrom, stop))
         seenBefore = "0"
-        if junction_string in annotated_junctions:
+        if (chrom, start, stop) in annotated_junctions:
             seenBefore = "1"
 
-        tag = ''
-
-        if annotated_start or annotated_stop:
-            # Canonical splicing and exon skipping -- both junction start and stop sites are annotated / known
-            if annotated_start and annotated_stop:
-                tag = "Both annotated"
-                for sample, count in samptimes.items():
-                    annotated_start_sample_count = annotated_start.get(sample, 0)
-                    annotated_stop_sample_count = annotated_stop.get(sample, 0)
-                    denominator = max(annotated_start_sample_count, annotated_stop_sample_count)
-                    try:
-                        normalized = round(float(count)/denominator, 3)
-                    except ZeroDivisionError:
-                        normalized = "".join([str(count), "*"])
-                    normalized_dict[sample] = normalized
-
-            # If only one end of splice junction is annotated, this implies exon extension / intron inclusion
-            # where the other end of the junction is not a canonically known splice site
-            elif annotated_start or annotated_stop:
-                tag = "One annotated"
-                for sample, count in samptimes.items():
-                    denominator = annotated_start.get(sample, 0) if annotated_start else annotated_stop.get(sample, 0)
-                    try:
-                        normalized = round(float(count)/denominator, 3)
-                    except ZeroDivisionError:
-                        normalized = "".join([str(count), "*"])
-                    normalized_dict[sample] = normalized
-
-            normalized_cols_sorted = [normalized_dict[s] for s in sample_ids]
-            line_to_print = "\t".join(
-                [gene, gene_type, chrom, start, stop, ntimes, nsamp,
-                 "\t".join(stringify_list_contents(sample_counts_sorted)),
-                 tag,
-                 seenBefore,
-                 "\t".join(stringify_list_contents(normalized_cols_sorted))]
-            )
-            print line_to_print
-
-        # If neither junction is annotated then simply just print out the original splice junction line
-        elif annotated_stop is None and annotated_stop is None:
+        # Canonical splicing and exon skipping -- both junction start and stop sites are annotated / known
+        if annotated_start and annotated_stop:
+            tag = "Both annotated"
+            denominators = [max(annotated_start_sample_count, annotated_stop_sample_count)
+                            for annotated_start_sample_count, annotated_stop_sample_count
+                            in zip(annotated_start, annotated_stop)]
+
+        # If only one end of splice junction is annotated, this implies exon extension / intron inclusion
+        # where the other end of the junction is not a canonically known splice site
+        elif annotated_start or annotated_stop:
+            tag = "One annotated"
+            denominators = annotated_start if annotated_start else annotated_stop
+
+        # If neither end is annotated then there is nothing to normalize against, so the normalized columns are left
+        # empty
+        else:
             tag = "Neither annotated"
-            line_to_print = "\t".join(
-                [gene, gene_type, chrom, start, stop, ntimes, nsamp,
-                 "\t".join(stringify_list_contents(sample_counts_sorted)),
-                 tag,
-                 seenBefore,
-                 '\t'.join(["" for s in sample_ids])]
-            )
-            print line_to_print
+            denominators = None
+
+        if denominators is None:
+            normalized_cols_sorted = ["" for s in sample_ids]
+        else:
+            normalized_cols_sorted = [normalize_count(count, denominator)
+                                      for count, denominator in zip(samptimes, denominators)]
+
+        line_to_print = "\t".join(
+            [gene, gene_type, chrom, start, stop, ntimes, nsamp,
+             "\t".join(stringify_list_contents(samptimes)),
+             tag,
+             seenBefore,
+             "\t".join(stringify_list_contents(normalized_cols_sorted))]
+        )
+        sys.stdout.write('{}\n'.format(line_to_print))
+
+
+def normalize_count(count, denominator):
+    try:
+        return round(float(count)/denominator, 3)
+    except ZeroDivisionError:
+        return "".join([str(count), "*"])
 
 
 def stringify_list_contents(x):
     return [str(s) for s in x]
 
 
-def get_junctions(splice_file, sample_ids):
+def get_junctions(splice_file_lines):
     """
-    :param splice_file: The output file from the SpliceJunctionDiscovery.py script
-    :return: a list of dicts representing junctions extracted from the file.
+    :param splice_file_lines: The lines of the output file from the SpliceJunctionDiscovery.py script, after its header
+    :return: a list of Junctions extracted from the file.
     """
     junctions = []
-
-    with open(splice_file, 'r') as f:
-        splice_file_lines = f.readlines()[1:]  # Start at 1 index to skip header line
-        for splice_file_line in splice_file_lines:
-            gene, gene_type, chrom, start, stop, ntimes, nsamp = splice_file_line.strip().split("\t")[0:7]
-            sample_counts = [int(c.strip()) for c in splice_file_line.split("\t")[7:]]
-            junctions.append({
-                'gene': gene,
-                'gene_type': gene_type,
-                'chrom': chrom,
-                'start': start,
-                'stop': stop,
-                'ntimes': ntimes,
-                'nsamp': nsamp,
-                'samptimes': {k: v for k, v in zip(sample_ids, sample_counts)}
-            })
+    for splice_file_line in splice_file_lines:
+        fields = splice_file_line.rstrip('\n').split("\t")
+        sample_counts = [int(c) for c in fields[7:]]
+        junctions.append(Junction(*fields[0:7], samptimes=sample_counts))
     return junctions
 
 
@@ -135,7 +108,8 @@ def make_annotated_junction_set(transcript_model, chrom_col, start_col, stop_col
     """From an annotations file, extract all annotated splice junctions, including every permutation with 1 bp flank on
     either side. For example, if a junction is annotated as 1:1221-1345, then we will include not only that version of
     it but also 1:1222-1346, 1:1220-1344, 1:1220-1346 and 1:1222-1344 to account for potential off-by-one indexing
-    differences."""
+    differences. Junctions are kept as (chrom, start, stop) tuples of strings, the same form they are read in from the
+    splice file, so that they can be looked up without formatting a string for every junction."""
     annotated_junctions = set()
 
     for junction in transcript_model:
@@ -145,28 +119,28 @@ def make_annotated_junction_set(transcript_model, chrom_col, start_col, stop_col
         start = int(fields[start_col])
         stop = int(fields[stop_col])
 
-        # shifts the junction while maintaining the same distance between start and stop
-        for offset in range(-1, 2):  # [-1,0,1]
-            start_flank = start + offset
-
-            # Offset by one because gencode end positions are 2 positions into the exon
-            # -- we want the first base of the exon (non-inclusive end position for intron)
-            stop_flank = stop -1 + offset
-            junction = "{}:{}-{}".format(chrom, start_flank, stop_flank)
-            annotated_junctions.add(junction)
-
-        # generate junctions with the most extreme flanking regions of start and stop
-        outer_junction = "{}:{}-{}".format(chrom, start - 1, stop + 1)
-        inner_junction = "{}:{}-{}".format(chrom, start + 1, stop - 1)
-        annotated_junctions.add(outer_junction)
-        annotated_junctions.add(inner_junction)
+        # Format each flanking position once, as the five junctions below share them
+        start_before, start_at, start_after = str(start - 1), str(start), str(start + 1)
+        stop_before_before, stop_before, stop_at, stop_after = str(stop - 2), str(stop - 1), str(stop), str(stop + 1)
+
+        annotated_junctions.update((
+            # shifts the junction by -1, 0 and +1 while maintaining the same distance between start and stop. The stop
+            # is offset by one because gencode end positions are 2 positions into the exon -- we want the first base
+            # of the exon (non-inclusive end position for intron)
+            (chrom, start_before, stop_before_before),
+            (chrom, start_at, stop_before),
+            (chrom, start_after, stop_at),
+            # the junctions with the most extreme flanking regions of start and stop
+            (chrom, start_before, stop_after),
+            (chrom, start_after, stop_before),
+        ))
 
     return annotated_junctions
 
 
 def main(args):
     if args.gzipped:
-        transcript_model = gzip.open(args.transcript_model)
+        transcript_model = gzip.open(args.transcript_model, 'rt')
     else:
         transcript_model = open(args.transcript_model)
 
@@ -176,10 +150,11 @@ def main(args):
                                                          args.stop_col)
 
     if args.normalize:
+        # Read the sample IDs from the header, then the junctions from the rest of the same open file
         with open(args.splice_file, 'r') as f:
             sample_ids = f.readline().split("\t")[7:]
+            splice_junctions = get_junctions(f)
 
-        splice_junctions = get_junctions(args.splice_file, sample_ids)
         annotated_counts = get_annotated_counts(splice_junctions, annotated_junction_set)
         normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_junction_set)
 
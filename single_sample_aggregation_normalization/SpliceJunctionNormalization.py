@@ -1,34 +1,41 @@
 import argparse
+import csv
 import gzip
-from collections import defaultdict
 import pandas as pd 
 import json
 import sys 
 import numpy as np
 
+# How many normalized lines to hold before writing them out together
+OUTPUT_CHUNK_LINES = 100000
+
+# Column types of the junctions file from combineJunctionAcrossSamples.py, so that pandas doesn't have to infer them.
+# Chromosomes are read as strings to match the chromosomes of the transcript model.
+COMBINED_JUNCTION_COLUMN_TYPES = {'gene': 'category', 'gene_type': 'category', 'chrom': str, 'start': np.int64,
+                                  'stop': np.int64, 'ntimes': np.int64, 'nsamp': np.int32, 'samptimes': str}
+
+
 def get_annotated_counts(splice_junctions, annotated_junctions):
     """If junction is annotated, note the max number of reads that align to each junction stop/start in all samples that
     carry it. E.g. if both of the following junctions were annotated:
         2:100-250 Beryl:20, Besse:10
         2:100-360 Beryl:30, Besse 4
     then the dictionary created should look like this:
-        {'2:100' :{'Beryl':30,'Besse':10},  2:250: {'Beryl':20,'Besse':10}, 2:360: {'Beryl':30, 'Besse': 4}"""
-    # {"chromosome:position": sample : times_seen_in_sample}
-    annotated_counts = defaultdict(lambda: defaultdict(lambda: int))
+        {('2', 100): {'Beryl':30,'Besse':10}, ('2', 250): {'Beryl':20,'Besse':10}, ('2', 360): {'Beryl':30, 'Besse': 4}}"""
+    # {(chromosome, position): sample : times_seen_in_sample}
+    annotated_counts = {}
     for junction in splice_junctions:
-        chrom, start, stop, samptimes = junction.get('chrom'), junction.get('start'), junction.get('stop'),\
-                                        junction.get('samptimes')
-        junction_string = '{}:{}-{}'.format(chrom, start, stop)
-        if junction_string in annotated_junctions:  # only consider both annotated
+        samptimes = junction['samptimes']
+        if junction['junction_key'] in annotated_junctions:  # only consider both annotated
 
-            for pos in [start, stop]:
-                pos = "{}:{}".format(chrom, pos)
+            for pos in [junction['start_key'], junction['stop_key']]:
+                annotated_counts_at_pos = annotated_counts.setdefault(pos, {})
                 for sample, count in samptimes.items():
-                    existing_count_for_sample_at_pos = annotated_counts[pos].get(sample)
+                    existing_count_for_sample_at_pos = annotated_counts_at_pos.get(sample)
                     if not existing_count_for_sample_at_pos:
-                        annotated_counts[pos][sample] = count
+                        annotated_counts_at_pos[sample] = count
                     elif existing_count_for_sample_at_pos and count > existing_count_for_sample_at_pos:
-                        annotated_counts[pos][sample] = count
+                        annotated_counts_at_pos[sample] = count
     return annotated_counts
 
 
@@ -37,24 +44,28 @@ def normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_j
         '\t'.join([s.strip() for s in sample_ids]),
         '\t'.join(['{}_normed'.format(s.strip()) for s in sample_ids])
     ))
+    # Collect the output lines and write them out in large chunks rather than with a print per junction
+    output_lines = []
     for junction in splice_junctions:
-        normalized_dict = defaultdict(int)
+        if len(output_lines) >= OUTPUT_CHUNK_LINES:
+            write_lines(output_lines)
+            output_lines = []
 
-        gene, gene_type, chrom, start, stop, ntimes, nsamp, samptimes = junction.get('gene'), \
-                                                                        junction.get('gene_type'), \
-                                                                        junction.get('chrom'), junction.get('start'), \
-                                                                        junction.get('stop'), junction.get('ntimes'),\
-                                                                        junction.get('nsamp'), junction.get('samptimes')
+        gene, gene_type, chrom, start, stop, ntimes, nsamp, samptimes = junction['gene'], junction['gene_type'], \
+                                                                        junction['chrom'], junction['start'], \
+                                                                        junction['stop'], junction['ntimes'], \
+                                                                        junction['nsamp'], junction['samptimes']
 
         sample_counts_sorted = [samptimes.get(s, 0) for s in sample_ids]
-        annotated_start = annotated_counts.get('{}:{}'.format(chrom, start))
-        annotated_stop = annotated_counts.get('{}:{}'.format(chrom, stop))
-        junction_string = '{}:{}-{}'.format(chrom, start, stop)
+        annotated_start = annotated_counts.get(junction['start_key'])
+        annotated_stop = annotated_counts.get(junction['stop_key'])
         seenBefore = "0"
-        if junction_string in annotated_junctions:
+        if junction['junction_key'] in annotated_junctions:
             seenBefore = "1"
 
         tag = ''
+        # Normalized counts are appended in sample order and joined once the line is built
+        normalized_cols_sorted = []
 
         if annotated_start or annotated_stop:
             # Canonical splicing and exon skipping -- both junction start and stop sites are annotated / known
@@ -69,7 +80,7 @@ def normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_j
                         normalized = round(float(count)/denominator, 3)
                     except ZeroDivisionError:
                         normalized = "".join([str(count), "*"])
-                    normalized_dict[sample] = normalized
+                    normalized_cols_sorted.append(normalized)
 
             # If only one end of splice junction is annotated, this implies exon extension / intron inclusion
             # where the other end of the junction is not a canonically known splice site
@@ -82,9 +93,8 @@ def normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_j
                         normalized = round(float(count)/denominator, 3)
                     except ZeroDivisionError:
                         normalized = "".join([str(count), "*"])
-                    normalized_dict[sample] = normalized
+                    normalized_cols_sorted.append(normalized)
 
-            normalized_cols_sorted = [normalized_dict[s] for s in sample_ids]
             line_to_print = "\t".join(
                 stringify_list_contents([gene, gene_type, chrom, start, stop, ntimes, nsamp,
                  "\t".join(stringify_list_contents(sample_counts_sorted)),
@@ -92,10 +102,10 @@ def normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_j
                  seenBefore,
                  "\t".join(stringify_list_contents(normalized_cols_sorted))])
             )
-            print(line_to_print)
+            output_lines.append(line_to_print)
 
         # If neither junction is annotated then simply just print out the original splice junction line
-        elif annotated_stop is None and annotated_stop is None:
+        else:
             tag = "Neither annotated"
             line_to_print = "\t".join(
                 stringify_list_contents([gene, gene_type, chrom, start, stop, ntimes, nsamp,
@@ -104,13 +114,49 @@ def normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_j
                  seenBefore,
                  '\t'.join(["" for _ in sample_ids])])
             )
-            print(line_to_print)
+            output_lines.append(line_to_print)
+
+    if output_lines:
+        write_lines(output_lines)
+
+
+def write_lines(lines):
+    sys.stdout.write('\n'.join(lines))
+    sys.stdout.write('\n')
+
+
+def add_junction_keys(splice_junctions):
+    """Build the (chrom, position) and (chrom, start, stop) keys each junction is looked up by in the annotated counts
+    and annotated junctions once, rather than again in both get_annotated_counts and normalize_counts"""
+    for junction in splice_junctions:
+        chrom, start, stop = junction['chrom'], junction['start'], junction['stop']
+        junction['start_key'] = (chrom, start)
+        junction['stop_key'] = (chrom, stop)
+        junction['junction_key'] = (chrom, start, stop)
 
 
 def stringify_list_contents(x):
     return [str(s) for s in x]
 
 
+def parse_samptimes(samptimes):
+    """Parse a samptimes JSON object of {sample: count} pairs. Sample IDs come from file names, so the pairs can be
+    split on commas and colons directly, which is much faster than the general purpose JSON decoder. Anything with
+    escape sequences, sample IDs containing commas and empty objects still go through json.loads."""
+    if '\\' in samptimes:
+        return json.loads(samptimes)
+    entries = samptimes.strip('{} ').split(',')
+    # Without escape sequences every sample ID is a pair of quotes, so any other count of entries means a comma split a
+    # sample ID
+    if samptimes.count('"') != 2 * len(entries):
+        return json.loads(samptimes)
+    sample_counts = {}
+    for entry in entries:
+        sample, count = entry.rsplit(':', 1)
+        sample_counts[sample.strip()[1:-1]] = int(count)
+    return sample_counts
+
+
 def get_junctions(splice_file, sample_ids):
     """
     :param splice_file: The output file from the SpliceJunctionDiscovery.py script
@@ -119,10 +165,11 @@ def get_junctions(splice_file, sample_ids):
     junctions = []
 
     with open(splice_file, 'r') as f:
-        splice_file_lines = f.readlines()[1:]  # Start at 1 index to skip header line
-        for splice_file_line in splice_file_lines:
-            gene, gene_type, chrom, start, stop, ntimes, nsamp = splice_file_line.strip().split("\t")[0:7]
-            sample_counts = [int(c.strip()) for c in splice_file_line.split("\t")[7:]]
+        next(f)  # Skip the header line
+        for splice_file_line in f:
+            fields = splice_file_line.rstrip('\n').split("\t")
+            gene, gene_type, chrom, start, stop, ntimes, nsamp = fields[0:7]
+            sample_counts = [int(c) for c in fields[7:]]
             junctions.append({
                 'gene': gene,
                 'gene_type': gene_type,
@@ -141,32 +188,24 @@ def make_annotated_junction_set(transcript_model, chrom_col, start_col, stop_col
     either side. For example, if a junction is annotated as 1:1221-1345, then we will include not only that version of
     it but also 1:1222-1346, 1:1220-1344, 1:1220-1346 and 1:1222-1344 to account for potential off-by-one indexing
     differences."""
-    annotated_junctions = set()
-
-    for junction in transcript_model:
-        fields = junction.strip().split("\t")
+    # Read only the three columns needed, and do the flanking arithmetic on whole columns at once rather than splitting
+    # and converting each line in Python. Junctions shared by several transcripts are only added once.
+    model_df = pd.read_csv(transcript_model, sep='\t', header=None, usecols=[chrom_col, start_col, stop_col],
+                           dtype={chrom_col: str, start_col: np.int64, stop_col: np.int64}, quoting=csv.QUOTE_NONE,
+                           engine='c').drop_duplicates()
+    chroms = model_df[chrom_col].str.strip('chr').tolist()
+    starts = model_df[start_col].values
+    stops = model_df[stop_col].values
 
-        chrom = fields[chrom_col].strip("chr")
-        start = int(fields[start_col])
-        stop = int(fields[stop_col])
-
-        # shifts the junction while maintaining the same distance between start and stop
-        for offset in range(-1, 2):  # [-1,0,1]
-            start_flank = start + offset
-
-            # Offset by one because gencode end positions are 2 positions into the exon
-            # -- we want the first base of the exon (non-inclusive end position for intron)
-            stop_flank = stop -1 + offset
-            junction = "{}:{}-{}".format(chrom, start_flank, stop_flank)
-            annotated_junctions.add(junction)
-
-        # generate junctions with the most extreme flanking regions of start and stop
-        outer_junction = "{}:{}-{}".format(chrom, start - 1, stop + 1)
-        inner_junction = "{}:{}-{}".format(chrom, start + 1, stop - 1)
-        annotated_junctions.add(outer_junction)
-        annotated_junctions.add(inner_junction)
+    annotated_junctions = set()
+    # (start, stop) offsets of each flanking junction. The first three shift the junction by -1, 0 and +1 while
+    # maintaining the same distance between start and stop. The stop is offset by one because gencode end positions are
+    # 2 positions into the exon -- we want the first base of the exon (non-inclusive end position for intron). The last
+    # two are the junctions with the most extreme flanking regions of start and stop
+    for start_offset, stop_offset in [(-1, -2), (0, -1), (1, 0), (-1, 1), (1, -1)]:
+        annotated_junctions.update(zip(chroms, (starts + start_offset).tolist(), (stops + stop_offset).tolist()))
 
-    return annotated_junctions
+    return frozenset(annotated_junctions)
 
 
 def main(args):
@@ -188,15 +227,17 @@ def main(args):
         #with open(args.splice_file, 'r') as f:   ###
             #sample_ids = f.readline().split("\t")[7:]
         
-        splice_df = pd.read_csv(args.splice_file, sep='\t')
+        splice_df = pd.read_csv(args.splice_file, sep='\t', dtype=COMBINED_JUNCTION_COLUMN_TYPES, engine='c')
 
         if "samptimes" in list(splice_df.columns.values):
-            samptimes_list = [json.loads(k) for k in splice_df.samptimes.values]
+            samptimes_list = [parse_samptimes(k) for k in splice_df.samptimes.values]
             sample_ids = np.unique([k for d in samptimes_list for k in d.keys()])
             sample_ids = [str(s_i) for s_i in sample_ids]
             if len(sample_ids) > 1:
-                splice_df['samptimes'] = splice_df['samptimes'].apply(lambda x: json.loads(x))
+                # Reuse the sample counts already parsed above rather than decoding every row's JSON a second time
+                splice_df['samptimes'] = samptimes_list
                 splice_junctions = splice_df.to_dict('records')
+                add_junction_keys(splice_junctions)
 
                 annotated_counts = get_annotated_counts(splice_junctions, annotated_junction_set)
                 normalize_counts(splice_junctions, annotated_counts, sample_ids, annotated_junction_set)
@@ -2,86 +2,113 @@ import argparse
 import os 
 from itertools import chain
 from glob import glob
+from multiprocessing import Pool, cpu_count
 import pandas as pd 
 import sys
 import json 
-from collections import OrderedDict, defaultdict 
 import numpy as np
 
+# Column types of the reformatted junction files, so that pandas doesn't have to infer them for every file. Gene names
+# and types repeat across many junctions, so they are read as categories.
+REFORMATTED_JUNCTION_COLUMN_TYPES = {'gene': 'category', 'gene_type': 'category', 'chrom': str, 'start': np.int64,
+                                     'stop': np.int64, 'samptimes': str}
+
+# Columns of the combined junction file
+COMBINED_JUNCTION_COLUMNS = ['gene', 'gene_type', 'chrom', 'start', 'stop', 'ntimes', 'nsamp', 'samptimes']
+
+
+def parse_samptimes(samptimes):
+    """Parse a samptimes JSON object of {sample: count} pairs. Sample IDs come from file names, so the pairs can be
+    split on commas and colons directly, which is much faster than the general purpose JSON decoder. Anything with
+    escape sequences, sample IDs containing commas and empty objects still go through json.loads."""
+    if '\\' in samptimes:
+        return json.loads(samptimes)
+    entries = samptimes.strip('{} ').split(',')
+    # Without escape sequences every sample ID is a pair of quotes, so any other count of entries means a comma split a
+    # sample ID
+    if samptimes.count('"') != 2 * len(entries):
+        return json.loads(samptimes)
+    sample_counts = {}
+    for entry in entries:
+        sample, count = entry.rsplit(':', 1)
+        sample_counts[sample.strip()[1:-1]] = int(count)
+    return sample_counts
+
+
+def read_reformatted_junctions(f):
+    """Read one sample's reformatted junction file. Returns the sample's ID and a frame of its junctions, with the
+    sample's ID and count for each junction in samp_id and ntimes columns in place of samptimes"""
+    # Read each file once, parsing its samptimes column both to find the sample ID and to combine its junctions.
+    # ntimes and nsamp are recomputed from samptimes, so they aren't read. Chromosomes are read as strings so that
+    # e.g. chromosome 2 is the same junction whether or not a file also has chromosome X.
+    splice_df = pd.read_csv(f, sep='\t', usecols=list(REFORMATTED_JUNCTION_COLUMN_TYPES),
+                            dtype=REFORMATTED_JUNCTION_COLUMN_TYPES, engine='c')
+
+    samptimes_list = [parse_samptimes(k) for k in splice_df['samptimes'].tolist()]
+
+    # Each reformatted file holds one sample, so every samptimes has a single (sample, count) entry and the sample ID
+    # is that of any one of them
+    samp_ids, ntimes = [], []
+    for samptimes in samptimes_list:
+        (samp_id, count), = samptimes.items()
+        samp_ids.append(samp_id)
+        ntimes.append(count)
+    sample_id = samp_ids[0]
+
+    splice_df = splice_df.drop('samptimes', axis=1)
+    splice_df['samp_id'] = samp_ids
+    splice_df['ntimes'] = ntimes
+    return sample_id, splice_df
+
+
 def main(args):
 
     sample_ids = []
 
     all_juncs = []
-    all_juncs_dict = OrderedDict()
 
-    for f in glob('{}/*.splicejunctions.reformatted.tsv'.format(args.input_junction_folder)):
-        splice_df = pd.read_csv(f, sep='\t')
+    junction_files = glob('{}/*.splicejunctions.reformatted.tsv'.format(args.input_junction_folder))
+
+    # Files are independent of each other until they are combined, so read them in parallel. map keeps them in glob
+    # order, so the output is the same as reading them one after another.
+    pool = Pool(args.threads)
+    try:
+        sample_junctions = pool.map(read_reformatted_junctions, junction_files)
+    finally:
+        pool.close()
+        pool.join()
 
-        samptimes_list = [json.loads(k) for k in splice_df.samptimes.values]
-        sample_id = np.unique([k for d in samptimes_list for k in d.keys()])[0]
-        
+    for sample_id, splice_df in sample_junctions:
         sys.stdout.write('Sample ID {}\n'.format(sample_id))
 
         sample_ids.append(sample_id)
-        
-    for f in glob('{}/*.splicejunctions.reformatted.tsv'.format(args.input_junction_folder)):
-
-        splice_df = pd.read_csv(f, sep='\t')
-        splice_df['samptimes'] = splice_df['samptimes'].apply(lambda x: json.loads(x))
-        splice_junctions = splice_df.to_dict('records')
-
-        for junction in splice_junctions:
-            chrom, start, stop, samptimes = junction.get('chrom'), junction.get('start'), junction.get('stop'), junction.get('samptimes')
-
-            (samp_id, ntimes), = samptimes.items()
-            junction_string = '{}:{}-{}'.format(chrom, start, stop)
-
- 
-            if junction_string in all_juncs_dict:
-                if samp_id in all_juncs_dict[junction_string]['samptimes']:
-                    all_juncs_dict[junction_string]['samptimes'][samp_id] += ntimes
-                else:
-                    all_juncs_dict[junction_string]['samptimes'][samp_id] = ntimes
-                all_juncs_dict[junction_string]['ntimes'] += ntimes
-                all_juncs_dict[junction_string]['nsamp'] += 1
-                
-
-            else:
-                all_juncs_dict[junction_string] = ({
-                    'gene': junction.get('gene'),
-                    'gene_type': junction.get('gene_type'),
-                    'chrom': chrom,
-                    'start': start,
-                    'stop': stop,
-                    'ntimes': ntimes,
-                    'nsamp': 1,
-                })
-
-                all_juncs_dict[junction_string]['samptimes'] = defaultdict(int)
-                all_juncs_dict[junction_string]['samptimes'][samp_id] = ntimes
-
-        
-        
-        #data = pd.read_csv(f, sep='\t')
-        #all_juncs.append(data)
-
-    
-
-    #df_all = pd.concat(all_juncs)
-
-    junc_values = list(all_juncs_dict.values())
-    new_junc_values = []
-    for juncs in junc_values:
-        temp_dict = juncs
-        temp_dict['nsamp'] = np.count_nonzero(np.asarray(list(temp_dict['samptimes'].values())))
-        temp_dict['samptimes'] = json.dumps(temp_dict['samptimes'])
-        new_junc_values.append(temp_dict)
-
-
-    output_df = pd.DataFrame(new_junc_values)
+
+        all_juncs.append(splice_df)
+
     output_file_name = '{}/{}_allsplicejunctions.tsv'.format(args.output_folder, args.sample_set_id)
 
+    # With no junction files there is nothing to combine, so just write the header
+    if not all_juncs:
+        pd.DataFrame(columns=COMBINED_JUNCTION_COLUMNS).to_csv(output_file_name, sep='\t', index=False)
+        return
+
+    df_all = pd.concat(all_juncs, ignore_index=True)
+
+    # Sum the counts of each sample for each junction, keeping junctions and the samples within each junction in the
+    # order they were first seen. A junction's gene and gene type are those of its first occurrence.
+    junction_columns = ['chrom', 'start', 'stop']
+    sample_counts = df_all.groupby(junction_columns + ['samp_id'], sort=False)['ntimes'].sum().reset_index()
+    junction_ids = sample_counts.groupby(junction_columns, sort=False).ngroup()
+
+    output_df = df_all.drop_duplicates(junction_columns)[['gene', 'gene_type'] + junction_columns].reset_index(drop=True)
+    output_df['ntimes'] = sample_counts['ntimes'].groupby(junction_ids).sum().values
+    output_df['nsamp'] = (sample_counts['ntimes'] != 0).groupby(junction_ids).sum().values
+
+    # Write samptimes as the same JSON objects json.dumps would give for each junction's {sample: count} dict
+    samp_id_json = {samp_id: json.dumps(samp_id) for samp_id in sample_counts['samp_id'].unique()}
+    sample_entries = sample_counts['samp_id'].map(samp_id_json) + ': ' + sample_counts['ntimes'].astype(str)
+    output_df['samptimes'] = ('{' + sample_entries.groupby(junction_ids).agg(', '.join) + '}').values
+
     output_df.to_csv(output_file_name, sep='\t', index=False)
 
 
@@ -92,6 +119,7 @@ if __name__ == '__main__':
     parser.add_argument('-input_junction_folder', help='folder containing all splice junctions from all samples')
     parser.add_argument('-output_folder', type=str, default='outputs', help='folder for outputs')
     parser.add_argument('-sample_set_id', type=str, default='sample_set', help='sample_set_id')
+    parser.add_argument('-threads', type=int, default=cpu_count(), help='number of files to read in parallel')
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -10,11 +10,17 @@ def junctions_from_file(splice_file):
 
     with open(splice_file, 'r') as f:
         sample_id = [k for k in f.readline().split("\t")[7:]][0].rstrip()
-        file_lines = f.readlines()[1:]
-
-        for l in file_lines:
-            gene, gene_type, chrom, start, stop, ntimes, nsamp = l.strip().split("\t")[0:7]
-            sample_counts = [int(c.strip()) for c in l.split("\t")[7:]]
+        # Every samptimes holds this one sample, so only its count needs formatting on each line rather than a whole
+        # dict going through json.dumps
+        samptimes_prefix = '{{{}: '.format(json.dumps(sample_id))
+        # Stream the rest of the file rather than reading it all into memory, still leaving out the first line after
+        # the header as before
+        next(f, None)
+
+        for l in f:
+            fields = l.rstrip('\n').split("\t")
+            gene, gene_type, chrom, start, stop, ntimes, nsamp = fields[0:7]
+            sample_counts = [int(c) for c in fields[7:]]
 
             junctions.append({
                 'gene': gene,
@@ -24,7 +30,7 @@ def junctions_from_file(splice_file):
                 'stop': stop,
                 'ntimes': ntimes,
                 'nsamp': nsamp,
-                'samptimes': json.dumps({sample_id: v for v in sample_counts})
+                'samptimes': '{}{}}}'.format(samptimes_prefix, sample_counts[-1])
             })
 
     return junctions
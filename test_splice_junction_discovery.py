@@ -1,7 +1,25 @@
+import importlib.util
+import json
+import os
 import unittest
 import numpy as np
+from collections import defaultdict
 from SpliceJunctionDiscovery import num_of_matches_before_first_intronic_section, length_of_first_intronic_section,\
-    get_first_splice_junction, get_end_position_from_junction, get_second_splice_junction
+    get_first_splice_junction, get_end_position_from_junction, get_second_splice_junction, get_introns_from_cigartuples,\
+    get_introns_from_cigar_string, format_splice_junction_entry, group_overlapping_genes, index_regions_by_contig, find_regions_containing,\
+    count_read_splice_junctions
+
+SINGLE_SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'single_sample_aggregation_normalization')
+
+
+def load_single_sample_script(script_name):
+    """Import one of the single-sample scripts by path, as its SpliceJunctionNormalization.py shares a name with the one
+    in this folder"""
+    spec = importlib.util.spec_from_file_location('single_sample_{}'.format(script_name),
+                                                  os.path.join(SINGLE_SAMPLE_DIR, '{}.py'.format(script_name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
 class TestDeconstructSigs(unittest.TestCase):
@@ -99,6 +117,141 @@ class TestDeconstructSigs(unittest.TestCase):
         sj = get_second_splice_junction(cigar_string, 2, pos, intron_end_position)
         self.assertEqual(sj, '{},{},{}'.format(t_chrom, intron_end_position+34, intron_end_position+34+2658))
 
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def test_get_introns_from_cigartuples_s(self):
+        # 8S13M221400N34M2658N29M
+        cigartuples = [(4, 8), (0, 13), (3, 221400), (0, 34), (3, 2658), (0, 29)]
+        pos = 5
+        self.assertEqual(get_introns_from_cigartuples(cigartuples, pos),
+                         [(pos+13, pos+13+221400), (pos+13+221400+34, pos+13+221400+34+2658)])
+
+    def test_get_introns_from_cigartuples_deletion(self):
+        # 3M1D40M20N
+        cigartuples = [(0, 3), (2, 1), (0, 40), (3, 20)]
+        pos = 5
+        self.assertEqual(get_introns_from_cigartuples(cigartuples, pos), [(pos+3+1+40, pos+3+1+40+20)])
+
+    def test_get_introns_from_cigartuples_insertion(self):
+        # 22M1I19M1893N6M
+        cigartuples = [(0, 22), (1, 1), (0, 19), (3, 1893), (0, 6)]
+        pos = 5
+        self.assertEqual(get_introns_from_cigartuples(cigartuples, pos), [(pos+22+19, pos+22+19+1893)])
+
+    def test_get_introns_from_cigartuples_unspliced(self):
+        self.assertEqual(get_introns_from_cigartuples([(0, 76)], 5), [])
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def test_get_introns_from_cigar_string_s(self):
+        pos = 5
+        self.assertEqual(get_introns_from_cigar_string('8S13M221400N34M2658N29M', pos),
+                         [(pos+13, pos+13+221400), (pos+13+221400+34, pos+13+221400+34+2658)])
+
+    def test_get_introns_from_cigar_string_deletion(self):
+        pos = 5
+        self.assertEqual(get_introns_from_cigar_string('3M1D40M20N', pos), [(pos+3+1+40, pos+3+1+40+20)])
+
+    def test_get_introns_from_cigar_string_insertion(self):
+        pos = 5
+        self.assertEqual(get_introns_from_cigar_string('22M1I19M1893N6M', pos), [(pos+22+19, pos+22+19+1893)])
+
+    def test_get_introns_from_cigar_string_unspliced(self):
+        self.assertEqual(get_introns_from_cigar_string('76M', 5), [])
+
+    def test_get_introns_from_cigar_string_matches_cigartuples(self):
+        # The samtools fallback must find the same introns as the pysam path
+        cigars = {'8S13M221400N34M2658N29M': [(4, 8), (0, 13), (3, 221400), (0, 34), (3, 2658), (0, 29)],
+                  '3M1D40M20N': [(0, 3), (2, 1), (0, 40), (3, 20)],
+                  '22M1I19M1893N6M': [(0, 22), (1, 1), (0, 19), (3, 1893), (0, 6)],
+                  '5H10=2X30M100N5P20M3S': [(5, 5), (7, 10), (8, 2), (0, 30), (3, 100), (6, 5), (0, 20), (4, 3)],
+                  '76M': [(0, 76)]}
+        for cigar_string, cigartuples in cigars.items():
+            self.assertEqual(get_introns_from_cigar_string(cigar_string, 5), get_introns_from_cigartuples(cigartuples, 5))
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def test_group_overlapping_genes(self):
+        genes = [{'t_gene': 'A', 't_chrom': '1', 't_start': 100, 't_stop': 500},
+                 {'t_gene': 'B', 't_chrom': '1', 't_start': 200, 't_stop': 300},  # nested in A
+                 {'t_gene': 'C', 't_chrom': '1', 't_start': 450, 't_stop': 700},  # overlaps A
+                 {'t_gene': 'D', 't_chrom': '1', 't_start': 700, 't_stop': 800},  # touches C
+                 {'t_gene': 'E', 't_chrom': '2', 't_start': 150, 't_stop': 250}]  # same positions, other chromosome
+        groups = group_overlapping_genes(reversed(genes))
+        self.assertEqual([[pa['t_gene'] for pa in group] for group in groups], [['A', 'B', 'C'], ['D'], ['E']])
+
+    def test_index_regions_by_contig_chr_prefix(self):
+        regions = [('2', 300, 400), ('2', 100, 250), ('X', 10, 20)]
+        regions_by_contig = index_regions_by_contig(regions, frozenset(['chr2', 'chrX']))
+        self.assertEqual(regions_by_contig, {'chr2': ([100, 300], [(100, 250, 1), (300, 400, 0)], 150),
+                                             'chrX': ([10], [(10, 20, 2)], 10)})
+
+    def test_index_regions_by_contig_no_chr_prefix(self):
+        regions = [('2', 100, 250)]
+        self.assertEqual(index_regions_by_contig(regions, frozenset(['1', '2'])), {'2': ([100], [(100, 250, 0)], 150)})
+
+    def test_index_regions_by_contig_missing_contig(self):
+        regions = [('2', 100, 250), ('MT', 10, 20)]
+        self.assertEqual(index_regions_by_contig(regions, frozenset(['chr1', 'chr2'])),
+                         {'chr2': ([100], [(100, 250, 0)], 150)})
+
+    def test_find_regions_containing_overlapping(self):
+        # A long region starting well before a short nested one, then one overlapping the end of the long region
+        contig_regions = index_regions_by_contig([('1', 100, 1000), ('1', 400, 500), ('1', 900, 1200)],
+                                                 frozenset(['1']))['1']
+        self.assertEqual(find_regions_containing(contig_regions, 450), [0, 1])
+        self.assertEqual(find_regions_containing(contig_regions, 950), [0, 2])
+        self.assertEqual(find_regions_containing(contig_regions, 1100), [2])
+        self.assertEqual(find_regions_containing(contig_regions, 50), [])
+        self.assertEqual(find_regions_containing(contig_regions, 1300), [])
+
+    def test_find_regions_containing_ends(self):
+        # Read positions equal to t_start or t_stop are outside of the region
+        contig_regions = index_regions_by_contig([('1', 100, 200), ('1', 200, 300)], frozenset(['1']))['1']
+        self.assertEqual(find_regions_containing(contig_regions, 100), [])
+        self.assertEqual(find_regions_containing(contig_regions, 101), [0])
+        self.assertEqual(find_regions_containing(contig_regions, 199), [0])
+        self.assertEqual(find_regions_containing(contig_regions, 200), [])
+        self.assertEqual(find_regions_containing(contig_regions, 201), [1])
+        self.assertEqual(find_regions_containing(contig_regions, 300), [])
+
+    def test_count_read_splice_junctions(self):
+        intron_counts = defaultdict(int)
+        count_read_splice_junctions(intron_counts, [(18, 221418)], 5, '13M221400N63M')
+        count_read_splice_junctions(intron_counts, [(18, 221418), (221452, 224110)], 5, '13M221400N34M2658N29M')
+        self.assertEqual(intron_counts, {(18, 221418): 2, (221452, 224110): 1})
+
+    def test_count_read_splice_junctions_more_than_two_introns(self):
+        # Reads spanning more than two introns are not counted at all
+        intron_counts = defaultdict(int)
+        count_read_splice_junctions(intron_counts, [(18, 118), (128, 228), (238, 338)], 5, '13M100N10M100N10M100N10M')
+        self.assertEqual(intron_counts, {})
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def test_format_splice_junction_entry(self):
+        event = ('NEB', 'protein_coding', '2', 152541490, 152543933)
+        entry = format_splice_junction_entry(event, {'D1': 274, 'N27': 3}, ['D1', 'E2', 'N27'])
+        self.assertEqual(entry, 'NEB\tprotein_coding\t2\t152541490\t152543933\t277\t2\t274\t0\t3\n')
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def test_parse_samptimes(self):
+        samptimes_cases = ['{"a": 1, "b": 2}',
+                           '{"D1": 274}',
+                           '{"S1:lane2": 3}',  # colon in the sample ID
+                           '{}',
+                           '{"caf\\u00e9": 2}',  # escaped, as written by json.dumps
+                           u'{"caf\u00e9": 2}',  # non-ASCII
+                           '{"a,b": 1, "c": 2}',  # comma in the sample ID
+                           '{"x:1,y": 2}',
+                           '{" a ": 5}']
+        # The same function is in both scripts that read samptimes
+        for script_name in ['combineJunctionAcrossSamples', 'SpliceJunctionNormalization']:
+            parse_samptimes = load_single_sample_script(script_name).parse_samptimes
+            for samptimes in samptimes_cases:
+                self.assertEqual(parse_samptimes(samptimes), json.loads(samptimes))
+
 
 if __name__ == '__main__':
     unittest.main()